@@ -998,7 +998,7 @@ ${contextInfo}`;
             return;
         }
         
-        const response = await fetch(`${API_BASE_URL}/generate-paper`, {
+        const response = await fetch(`${API_BASE_URL}/generate-paper/stream`, {
             method: 'POST',
             headers: {
                 'Authorization': authToken ? `Bearer ${authToken}` : ''
@@ -1021,7 +1021,15 @@ ${contextInfo}`;
             throw new Error(errorMessage);
         }
 
-        const data = await response.json();
+        // Render each section as soon as the server streams it
+        const data = await readPaperStream(response, (partialContent) => {
+            renderPaperPreview({
+                title, subject, date, time, marks, difficulty, topics, instructions, questionTypes,
+                content: partialContent,
+                ai_used: false,
+                used_context: false
+            });
+        });
         console.log('Success response:', data);
 
         paperData = {
@@ -1053,6 +1061,51 @@ ${contextInfo}`;
     }
 }
 
+// Read the Server-Sent Events stream from /generate-paper/stream.
+// Calls onSection with the content received so far and resolves with the final 'done' payload.
+async function readPaperStream(response, onSection) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    const sections = [];
+    let buffer = '';
+    let result = null;
+
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const rawEvent = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+
+            let eventName = 'message';
+            let dataText = '';
+            rawEvent.split('\n').forEach(line => {
+                if (line.startsWith('event: ')) eventName = line.slice(7);
+                else if (line.startsWith('data: ')) dataText += line.slice(6);
+            });
+            if (!dataText) continue;
+
+            const payload = JSON.parse(dataText);
+            if (eventName === 'section') {
+                sections.push(payload.content);
+                onSection(sections.join('\n\n'));
+            } else if (eventName === 'done') {
+                result = payload;
+            } else if (eventName === 'error') {
+                throw new Error(payload.message || 'Failed to generate paper');
+            }
+        }
+    }
+
+    if (!result) {
+        throw new Error('Paper generation stream ended unexpectedly');
+    }
+    return result;
+}
+
 function renderPaperPreview(data) {
     const previewContent = document.getElementById('previewContent');
     const paperPreview = document.getElementById('paperPreview');
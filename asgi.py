@@ -0,0 +1,342 @@
+"""ASGI entry point: uvicorn asgi:application
+
+The paper, validation and material endpoints run as coroutines here, so a
+request waiting on Gemini holds no thread and one process can keep hundreds
+of model calls in flight. Forms are still parsed by the Flask code in app.py
+(on the blocking pool), so both serving modes accept and return exactly the
+same requests and responses. Job progress streams are also served here, awaiting
+the job's change notifications, so a watcher holds no thread either. Every other
+route, including the paper SSE stream and static files, goes through a WSGI
+bridge to the Flask app.
+"""
+import asyncio
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Response, jsonify
+from werkzeug.exceptions import RequestEntityTooLarge
+
+import app as backend
+
+flask_app = backend.app
+logger = backend.logger
+
+# Threads for routes served through the WSGI bridge; a streaming response holds one for its duration
+ASGI_WSGI_WORKERS = int(os.getenv('ASGI_WSGI_WORKERS', '64'))
+wsgi_executor = ThreadPoolExecutor(max_workers=ASGI_WSGI_WORKERS, thread_name_prefix='wsgi')
+
+def error_message(e):
+    return e.description if isinstance(e, RequestEntityTooLarge) else None
+
+# Coroutine routes. Each reuses the Flask view's parser, job submitter and
+# error payloads, and swaps its blocking runner for the async counterpart.
+ASYNC_ROUTES = {
+    ('POST', '/api/generate-paper'): {
+        'endpoint': 'generate_paper',
+        'parse': backend.parse_paper_request,
+        'submit': backend.submit_paper_job,
+        'run': backend.run_generate_paper_async,
+        'release': backend.release_paper_uploads,
+        'error': lambda e: {'message': error_message(e) or f'Server error occurred: {str(e)}'},
+        'log': 'Generate paper error'
+    },
+    ('POST', '/api/validate-answers'): {
+        'endpoint': 'validate_answers',
+        'parse': backend.parse_validate_request,
+        'submit': backend.submit_validation_job,
+        'run': backend.run_validate_answers_async,
+        'release': backend.release_validation_uploads,
+        'error': lambda e: {'message': error_message(e) or 'Server error occurred'},
+        'log': 'Validate answers error'
+    },
+    ('POST', '/api/generate-material'): {
+        'endpoint': 'generate_material',
+        'parse': backend.parse_material_request,
+        'submit': backend.submit_material_job,
+        'run': backend.run_generate_material_async,
+        'release': backend.release_material_uploads,
+        'error': lambda e: {'success': False, 'message': error_message(e) or f'Error: {str(e)}'},
+        'log': 'Generate material error'
+    }
+}
+
+async def read_body(receive, declared_length):
+    """Spool the request body. Returns (body, size), or (None, 0) if the client went away.
+
+    Reading stops once the body passes MAX_REQUEST_BYTES; Flask then rejects it
+    from the size in CONTENT_LENGTH without looking at the body.
+    """
+    body = tempfile.SpooledTemporaryFile(max_size=backend.UPLOAD_SPOOL_THRESHOLD)
+    size = 0
+    if declared_length is not None and declared_length > backend.MAX_REQUEST_BYTES:
+        return body, declared_length
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            body.close()
+            return None, 0
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > backend.MAX_REQUEST_BYTES:
+            body.seek(0)
+            body.truncate()
+            return body, size
+        body.write(chunk)
+        if not message.get('more_body', False):
+            break
+    body.seek(0)
+    return body, size
+
+def build_environ(scope, body, size):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'CONTENT_LENGTH': str(size),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name != 'CONTENT_LENGTH':
+            key = f"HTTP_{name}"
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+def declared_content_length(scope):
+    for name, value in scope['headers']:
+        if name.lower() == b'content-length':
+            try:
+                return int(value)
+            except ValueError:
+                return None
+    return None
+
+def build_response(rv):
+    """Turn a view-style return value into a response, running Flask's after_request hooks (CORS)"""
+    return flask_app.process_response(flask_app.make_response(rv))
+
+def finish_response(environ, rv):
+    with flask_app.request_context(environ):
+        return build_response(rv)
+
+def parse_request(route, environ):
+    """Run the route's Flask parser. Returns (params, None) or (None, finished_response)."""
+    with flask_app.request_context(environ):
+        try:
+            with backend.timed(backend.stage_histogram, stage=route['parse'].__name__):
+                params, async_job, error_response = route['parse']()
+            if error_response:
+                return None, build_response(error_response)
+            if async_job:
+                try:
+                    job = route['submit'](params)
+                except Exception:
+                    if route.get('release'):
+                        route['release'](params)
+                    raise
+                return None, build_response((jsonify(backend.job_accepted_response(job)), 202))
+            return params, None
+        except RequestEntityTooLarge as e:
+            return None, build_response((jsonify(route['error'](e)), 413))
+        except Exception as e:
+            logger.error(f"{route['log']}: {str(e)}")
+            return None, build_response((jsonify(route['error'](e)), 500))
+
+async def send_flask_response(send, response):
+    await send({
+        'type': 'http.response.start',
+        'status': response.status_code,
+        'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in response.headers.to_wsgi_list()]
+    })
+    await send({'type': 'http.response.body', 'body': response.get_data()})
+
+async def handle_async_route(route, scope, send, environ):
+    start = time.perf_counter()
+    params, response = await backend.run_blocking(parse_request, route, environ)
+    if response is None:
+        try:
+            payload, status = await route['run'](**params)
+        except Exception as e:
+            if route.get('release'):
+                route['release'](params)
+            logger.error(f"{route['log']}: {str(e)}")
+            payload, status = route['error'](e), 500
+        response = await backend.run_blocking(finish_response, environ, (payload, status))
+    await send_flask_response(send, response)
+    backend.request_histogram.observe(time.perf_counter() - start, endpoint=route['endpoint'],
+                                      method=scope['method'], status=response.status_code)
+
+# GET /api/jobs/<job_id>/events, served from backend.job_event_stream
+JOB_EVENTS_PATH = re.compile(r'^/api/jobs/([^/]+)/events$')
+
+def open_job_events(environ, job_id):
+    """Check the caller may read the job. Returns the Flask response to start the stream with, or a 404."""
+    with flask_app.request_context(environ):
+        job = backend.get_job(job_id)
+        if not job or not backend.can_read_job(job):
+            return build_response((jsonify({'message': 'Job not found'}), 404))
+        return build_response(Response(iter(()), mimetype='text/event-stream', headers=backend.JOB_EVENTS_HEADERS))
+
+async def stream_job_events(job_id, scope, receive, send, environ):
+    start = time.perf_counter()
+    response = await backend.run_blocking(open_job_events, environ, job_id)
+    if response.status_code != 200:
+        await send_flask_response(send, response)
+        return
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in response.headers.to_wsgi_list()]
+    })
+    
+    finished = object()
+    events = backend.job_event_stream(job_id)
+    watcher = asyncio.ensure_future(watch_disconnect(receive, threading.Event()))
+    try:
+        while not watcher.done():
+            # Steps are brief, but a job owned by another worker is read from the database
+            item = await backend.run_blocking(next, events, finished)
+            if item is finished:
+                break
+            if isinstance(item, str):
+                await send({'type': 'http.response.body', 'body': item.encode('utf-8'), 'more_body': True})
+            elif item is None:
+                await asyncio.wait({watcher}, timeout=backend.JOB_EVENTS_POLL_INTERVAL)
+            else:
+                changed = asyncio.wrap_future(item)
+                while True:
+                    await asyncio.wait({changed, watcher}, timeout=backend.JOB_EVENTS_KEEPALIVE,
+                                       return_when=asyncio.FIRST_COMPLETED)
+                    if changed.done() or watcher.done():
+                        break
+                    await send({'type': 'http.response.body', 'body': backend.SSE_KEEPALIVE.encode('utf-8'), 'more_body': True})
+        if not watcher.done():
+            await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        watcher.cancel()
+        events.close()
+        backend.request_histogram.observe(time.perf_counter() - start, endpoint='job_events',
+                                          method=scope['method'], status=200)
+
+async def watch_disconnect(receive, disconnected):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            disconnected.set()
+            return
+
+async def call_wsgi(scope, receive, send, environ):
+    """Serve a request with the Flask WSGI app on a worker thread, streaming its body back"""
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    disconnected = threading.Event()
+
+    def put(item):
+        loop.call_soon_threadsafe(queue.put_nowait, item)
+
+    def start_response(status, headers, exc_info=None):
+        put(('start', int(status.split(' ', 1)[0]), headers))
+        return lambda data: put(('body', data))
+
+    def run():
+        try:
+            result = flask_app(environ, start_response)
+            try:
+                for chunk in result:
+                    # Stop pulling from a stream once the client has gone
+                    if disconnected.is_set():
+                        break
+                    if chunk:
+                        put(('body', chunk))
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        except Exception as e:
+            logger.error(f"WSGI bridge error for {environ['PATH_INFO']}: {str(e)}")
+            put(('error', e))
+        finally:
+            put(('end', None))
+
+    started = False
+    loop.run_in_executor(wsgi_executor, run)
+    watcher = asyncio.ensure_future(watch_disconnect(receive, disconnected))
+    try:
+        while True:
+            kind, *item = await queue.get()
+            if kind == 'start':
+                status, headers = item
+                await send({
+                    'type': 'http.response.start',
+                    'status': status,
+                    'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+                })
+                started = True
+            elif kind == 'body':
+                await send({'type': 'http.response.body', 'body': item[0], 'more_body': True})
+            elif kind == 'error' and not started:
+                await send({'type': 'http.response.start', 'status': 500,
+                            'headers': [(b'content-type', b'text/plain; charset=utf-8')]})
+                await send({'type': 'http.response.body', 'body': b'Internal Server Error'})
+                return
+            else:
+                break
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        disconnected.set()
+        watcher.cancel()
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            logger.info(f"⚡ ASGI app ready (async routes: {', '.join(route['endpoint'] for route in ASYNC_ROUTES.values())})")
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            # Flushing blocks; keep the loop free for coroutine routes that are still draining
+            await backend.run_blocking(backend.mail_sender.flush, timeout=5)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    body, size = await read_body(receive, declared_content_length(scope))
+    if body is None:
+        return
+    try:
+        environ = build_environ(scope, body, size)
+        route = ASYNC_ROUTES.get((scope['method'], scope['path']))
+        job_events = JOB_EVENTS_PATH.match(scope['path']) if scope['method'] == 'GET' else None
+        if route and size <= backend.MAX_REQUEST_BYTES:
+            await handle_async_route(route, scope, send, environ)
+        elif job_events:
+            await stream_job_events(job_events.group(1), scope, receive, send, environ)
+        else:
+            await call_wsgi(scope, receive, send, environ)
+    finally:
+        body.close()
@@ -0,0 +1,367 @@
+# benchmark.py - Load test for app.py against a fake Gemini module and the in-memory store
+#
+# Usage:
+#   python benchmark.py                                  # all scenarios, default settings
+#   python benchmark.py --scenarios login generate-paper --requests 200 --concurrency 16
+#   python benchmark.py --latency 1.5 --error-rate 0.05 --json bench.json
+#   python benchmark.py --asgi --concurrency 64                # serve asgi.py with uvicorn
+#
+# The Flask app is served by a threaded werkzeug server (or asgi.py under uvicorn with
+# --asgi) on a local port and driven over real HTTP. Gemini is replaced by FakeGenerativeModel (configurable latency, jitter,
+# error rate and response size) and MongoDB by the in-memory store (MONGO_URI=memory://).
+import argparse
+import asyncio
+import io
+import json
+import logging
+import os
+import random
+import resource
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault('MONGO_URI', 'memory://')
+os.environ.setdefault('GEMINI_RATE_LIMIT_RPM', '0')
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeResourceExhausted(Exception):
+    """Injected upstream error; carries the HTTP status like google.api_core exceptions do"""
+    code = 429
+
+
+class FakeGenerativeModel:
+    """Stand-in for genai.GenerativeModel that answers each prompt type with a plausible payload"""
+    latency = 0.5
+    jitter = 0.2
+    error_rate = 0.0
+    response_size = 4000
+
+    def __init__(self, model_name):
+        self.model_name = model_name
+
+    def _delay(self, scale=1.0):
+        return max(0.0, random.gauss(self.latency, self.latency * self.jitter)) * scale
+
+    def _maybe_fail(self):
+        if random.random() < self.error_rate:
+            raise FakeResourceExhausted("Injected Gemini error (429 Resource exhausted)")
+
+    def _sleep(self, scale=1.0):
+        time.sleep(self._delay(scale))
+        self._maybe_fail()
+
+    def _text_for(self, contents):
+        prompt = contents if isinstance(contents, str) else next((c for c in contents if isinstance(c, str)), '')
+        if '=== SHEET' in prompt:
+            count = prompt.count('=== SHEET')
+            return json.dumps([
+                {'sheet': n, 'marks': random.randint(40, 98), 'grade': 'B', 'feedback': 'Good attempt.'}
+                for n in range(1, count + 1)
+            ])
+        if 'Evaluate this student' in prompt:
+            return json.dumps({'marks': random.randint(40, 98), 'grade': 'B', 'feedback': 'Good attempt.'})
+        if 'Extract all text' in prompt:
+            return 'Q1. Photosynthesis converts light energy into chemical energy. ' * 20
+        if 'Summarize' in prompt:
+            lines = ['A concise summary of the uploaded material.']
+            lines += [f'- Key point {n}' for n in range(1, 11)]
+            return '\n'.join(lines)
+        return fake_paper(self.response_size)
+
+    def generate_content(self, contents, stream=False, **kwargs):
+        if not stream:
+            self._sleep()
+            return FakeResponse(self._text_for(contents))
+
+        def chunks():
+            self._sleep(0.2)
+            text = self._text_for(contents)
+            step = max(1, len(text) // 8)
+            for i in range(0, len(text), step):
+                time.sleep(self.latency * 0.1)
+                yield FakeResponse(text[i:i + step])
+        return chunks()
+
+    async def generate_content_async(self, contents, **kwargs):
+        await asyncio.sleep(self._delay())
+        self._maybe_fail()
+        return FakeResponse(self._text_for(contents))
+
+
+def fake_paper(size):
+    sections = []
+    question = 1
+    for letter in 'ABC':
+        lines = [f"SECTION {letter}: Questions (Marks: 20)"]
+        for _ in range(5):
+            lines.append(f"Q{question}. Explain concept number {question} with an example. (4 marks)")
+            question += 1
+        sections.append('\n'.join(lines))
+    text = "SAMPLE QUESTION PAPER\n\n" + '\n\n'.join(sections)
+    return (text + '\n') * max(1, size // len(text))
+
+
+# Fixtures
+def make_pdf(pages=5):
+    """Minimal multi-page PDF with a text layer"""
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>"]
+    kids = ' '.join(f"{3 + 2 * i} 0 R" for i in range(pages))
+    objects.append(f"<< /Type /Pages /Kids [{kids}] /Count {pages} >>")
+    font_ref = 3 + 2 * pages
+    for i in range(pages):
+        stream = f"BT /F1 12 Tf 50 700 Td (Page {i + 1}: cells, tissues, organs and organ systems.) Tj ET"
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents {4 + 2 * i} 0 R "
+                       f"/Resources << /Font << /F1 {font_ref} 0 R >> >> >>")
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+    objects.append("<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+
+    out = "%PDF-1.4\n"
+    offsets = []
+    for n, obj in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{n} 0 obj\n{obj}\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n"
+    out += ''.join(f"{offset:010d} 00000 n \n" for offset in offsets)
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF"
+    return out.encode('latin-1')
+
+
+def make_docx(paragraphs=40):
+    from docx import Document
+    doc = Document()
+    for n in range(paragraphs):
+        doc.add_paragraph(f"Answer {n + 1}: The mitochondria is the powerhouse of the cell.")
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+
+def make_png(width=1600, height=1200):
+    from PIL import Image, ImageDraw
+    image = Image.new('RGB', (width, height), 'white')
+    draw = ImageDraw.Draw(image)
+    for row in range(0, height, 40):
+        draw.text((40, row), f"Line {row // 40}: handwritten answer text", fill='black')
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def encode_multipart(fields, files):
+    """Build a multipart/form-data body. files is [(field, filename, content_type, bytes)]."""
+    boundary = uuid.uuid4().hex
+    body = io.BytesIO()
+    for name, value in fields.items():
+        values = value if isinstance(value, list) else [value]
+        for item in values:
+            body.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{item}\r\n'.encode())
+    for field, filename, content_type, data in files:
+        body.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+                   f'Content-Type: {content_type}\r\n\r\n'.encode())
+        body.write(data)
+        body.write(b'\r\n')
+    body.write(f'--{boundary}--\r\n'.encode())
+    return body.getvalue(), f'multipart/form-data; boundary={boundary}'
+
+
+# Scenarios: each returns (method, path, body, content_type) for request number n
+class Scenarios:
+    def __init__(self, sheets_per_request):
+        self.pdf = make_pdf()
+        self.docx = make_docx()
+        self.png = make_png()
+        self.sheets_per_request = sheets_per_request
+        self.login_email = f"bench-{uuid.uuid4().hex[:8]}@example.com"
+
+    def setup(self, base_url):
+        body = json.dumps({'name': 'Bench', 'email': self.login_email, 'password': 'bench-password'}).encode()
+        send(base_url, 'POST', '/api/register', body, 'application/json')
+
+    def login(self, n):
+        body = json.dumps({'email': self.login_email, 'password': 'bench-password'}).encode()
+        return 'POST', '/api/login', body, 'application/json'
+
+    def generate_paper(self, n):
+        fields = {
+            'title': f'Benchmark Paper {n}',
+            'subject': 'Biology',
+            'topics': f'Cells, Genetics, Topic {n}',
+            'difficulty': 'medium',
+            'total_marks': '60',
+            'question_types[]': ['mcq', 'short', 'long']
+        }
+        body, content_type = encode_multipart(fields, [('context_file', 'syllabus.pdf', 'application/pdf', self.pdf)])
+        return 'POST', '/api/generate-paper', body, content_type
+
+    def validate_answers(self, n):
+        fixtures = [('pdf', 'application/pdf', self.pdf), ('docx', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document', self.docx), ('png', 'image/png', self.png)]
+        files = [('answer_key', 'key.txt', 'text/plain', b'Q1: photosynthesis. Q2: mitosis. Q3: osmosis.')]
+        for i in range(self.sheets_per_request):
+            ext, content_type, data = fixtures[i % len(fixtures)]
+            files.append(('files', f'student_{n}_{i}.{ext}', content_type, data))
+        body, content_type = encode_multipart({}, files)
+        return 'POST', '/api/validate-answers', body, content_type
+
+    def generate_material(self, n):
+        fields = {'summary_length': 'medium', 'notes_count': '5', 'topics': 'Cells', 'material_types': '["summary"]'}
+        body, content_type = encode_multipart(fields, [('file', f'notes_{n}.docx', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document', self.docx)])
+        return 'POST', '/api/generate-material', body, content_type
+
+
+SCENARIOS = {
+    'login': Scenarios.login,
+    'generate-paper': Scenarios.generate_paper,
+    'validate-answers': Scenarios.validate_answers,
+    'generate-material': Scenarios.generate_material
+}
+
+
+def send(base_url, method, path, body, content_type):
+    req = urllib.request.Request(base_url + path, data=body, method=method, headers={'Content-Type': content_type})
+    try:
+        with urllib.request.urlopen(req, timeout=300) as resp:
+            resp.read()
+            return resp.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def run_scenario(base_url, scenarios, name, total_requests, concurrency):
+    build = SCENARIOS[name]
+    requests = [build(scenarios, n) for n in range(total_requests)]
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+
+    def worker(args):
+        start = time.perf_counter()
+        try:
+            status = send(base_url, *args)
+        except Exception as e:
+            status = type(e).__name__
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    tracemalloc.reset_peak()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(worker, requests))
+    wall = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+
+    return {
+        'scenario': name,
+        'requests': total_requests,
+        'concurrency': concurrency,
+        'rps': round(total_requests / wall, 2) if wall else 0.0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+        'mean_ms': round(statistics.mean(latencies) * 1000, 1) if latencies else 0.0,
+        'peak_python_mb': round(peak / (1024 * 1024), 1),
+        'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'statuses': {str(k): v for k, v in sorted(statuses.items(), key=lambda item: str(item[0]))}
+    }
+
+
+def start_server(flask_app, port):
+    from werkzeug.serving import make_server
+    server = make_server('127.0.0.1', port, flask_app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='bench-server', daemon=True).start()
+    return server
+
+
+class AsgiServer:
+    """uvicorn serving asgi.py on a background thread, with the same shutdown() as the werkzeug server"""
+    def __init__(self, port):
+        import uvicorn
+        from asgi import application
+        self.server = uvicorn.Server(uvicorn.Config(application, host='127.0.0.1', port=port, log_level='warning'))
+        self.thread = threading.Thread(target=self.server.run, name='bench-server', daemon=True)
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.05)
+
+    def shutdown(self):
+        self.server.should_exit = True
+        self.thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark app.py endpoints against a fake Gemini model')
+    parser.add_argument('--scenarios', nargs='+', choices=sorted(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--requests', type=int, default=50, help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--sheets', type=int, default=6, help='answer sheets per validate-answers request')
+    parser.add_argument('--latency', type=float, default=0.5, help='mean fake Gemini latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.2, help='latency standard deviation as a fraction of the mean')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of fake Gemini calls that raise')
+    parser.add_argument('--response-size', type=int, default=4000, help='approximate characters per generated paper')
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--asgi', action='store_true', help='serve asgi.py with uvicorn instead of the threaded Flask server')
+    parser.add_argument('--json', help='also write results to this JSON file')
+    args = parser.parse_args()
+
+    FakeGenerativeModel.latency = args.latency
+    FakeGenerativeModel.jitter = args.jitter
+    FakeGenerativeModel.error_rate = args.error_rate
+    FakeGenerativeModel.response_size = args.response_size
+
+    tracemalloc.start()
+    import app as app_module
+    app_module.genai = type('FakeGenai', (), {'GenerativeModel': FakeGenerativeModel})
+    app_module.GEMINI_API_KEY = app_module.GEMINI_API_KEY or 'benchmark'
+    app_module.model_clients.clear()
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    server = AsgiServer(args.port) if args.asgi else start_server(app_module.app, args.port)
+    base_url = f"http://127.0.0.1:{args.port}"
+    scenarios = Scenarios(args.sheets)
+    scenarios.setup(base_url)
+
+    results = []
+    try:
+        for name in args.scenarios:
+            result = run_scenario(base_url, scenarios, name, args.requests, args.concurrency)
+            results.append(result)
+    finally:
+        server.shutdown()
+
+    header = f"{'scenario':<18} {'reqs':>5} {'conc':>5} {'rps':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'py peak MB':>11} {'rss MB':>8}  statuses"
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        print(f"{r['scenario']:<18} {r['requests']:>5} {r['concurrency']:>5} {r['rps']:>8} {r['p50_ms']:>9} {r['p95_ms']:>9} "
+              f"{r['p99_ms']:>9} {r['peak_python_mb']:>11} {r['max_rss_mb']:>8}  {r['statuses']}")
+
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump({'settings': vars(args), 'results': results}, fh, indent=2)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
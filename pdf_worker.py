@@ -0,0 +1,19 @@
+"""PDF page extraction for the process pool in app.py.
+
+Worker processes import only this module, never the Flask app, so starting one
+does not connect to MongoDB, start the app's background threads or recover jobs.
+"""
+import io
+import time
+
+import PyPDF2
+
+def extract_pdf_pages(source, start, end):
+    """Extract pages [start, end) of a PDF given as a file path or bytes. Returns [(page_number, text, seconds)]."""
+    pdf_reader = PyPDF2.PdfReader(source if isinstance(source, str) else io.BytesIO(source))
+    pages = []
+    for page_number in range(start, min(end, len(pdf_reader.pages))):
+        page_start = time.perf_counter()
+        extracted = pdf_reader.pages[page_number].extract_text() or ''
+        pages.append((page_number, extracted, time.perf_counter() - page_start))
+    return pages